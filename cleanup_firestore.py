@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Interactively delete study documents from Firestore.
+- Lists every study in the 'studies' collection
+- Prompts per study (or takes --all to select everything)
+- Commits all confirmed deletes in batches of up to 499 writes
+"""
+
+import sys
+import json
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+BATCH_LIMIT = 499  # Firestore allows at most 500 writes per batch
+
+def delete_in_batches(db, studies_ref, doc_ids):
+    """Delete documents via WriteBatch commits instead of one RPC per delete."""
+    batch = db.batch()
+    count = 0
+
+    for doc_id in doc_ids:
+        batch.delete(studies_ref.document(doc_id))
+        count += 1
+        if count >= BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            count = 0
+
+    if count:
+        batch.commit()
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python cleanup_firestore.py <service_account.json> [--all]")
+        print()
+        print("Prompts for each study before deleting it from Firestore.")
+        print("Add --all to select every study without prompting.")
+        sys.exit(1)
+
+    service_account_path = sys.argv[1]
+    delete_all = '--all' in sys.argv
+
+    with open(service_account_path) as f:
+        project_id = json.load(f)['project_id']
+
+    print("🔥 Initializing Firebase...")
+    cred = credentials.Certificate(service_account_path)
+    firebase_admin.initialize_app(cred)
+    db = firestore.client()
+    print(f"✅ Connected to project {project_id}")
+    print()
+
+    studies_ref = db.collection('studies')
+
+    # Collect affirmative answers first, then commit them in batches -
+    # deleting one document per RPC inside the prompt loop is slow
+    to_delete_doc_ids = []
+    total = 0
+
+    for doc in studies_ref.stream():
+        total += 1
+        study_id = doc.to_dict().get('study_id', doc.id)
+
+        if delete_all:
+            to_delete_doc_ids.append(doc.id)
+            continue
+
+        response = input(f"Delete study {study_id}? (yes/no): ")
+        if response.lower() == 'yes':
+            to_delete_doc_ids.append(doc.id)
+
+    print()
+    print(f"📊 {len(to_delete_doc_ids)} of {total} studies selected for deletion")
+
+    if not to_delete_doc_ids:
+        print("Nothing to delete.")
+        return
+
+    if delete_all:
+        response = input(f"⚠️  Really delete ALL {len(to_delete_doc_ids)} studies? (yes/no): ")
+        if response.lower() != 'yes':
+            print("❌ Cancelled")
+            return
+
+    delete_in_batches(db, studies_ref, to_delete_doc_ids)
+
+    print(f"✅ Deleted {len(to_delete_doc_ids)} studies")
+
+if __name__ == '__main__':
+    main()
@@ -258,15 +258,55 @@ class LSTVAnnotationApp {
         }
     }
 
+    // Extract filenames from a series, handling both the parallel-array
+    // files layout and the legacy array-of-objects layout
+    getSeriesFilenames(series) {
+        if (series.files && Array.isArray(series.files.filenames)) {
+            return series.files.filenames;
+        }
+        if (series.files && Array.isArray(series.files)) {
+            return series.files.map(f => f.filename);
+        }
+        return null;
+    }
+
     // Load DICOM files for a series
     async loadDicomFiles(studyId, series) {
         try {
             console.log(`Loading series ${series.series_id} for study ${studyId}...`);
             
+            // Packed series: every slice lives in one series.dcm object,
+            // downloaded once and sliced by the recorded byte ranges
+            if (series.files && Array.isArray(series.files.byte_offsets)) {
+                const files = await storageManager.downloadPackedSeries(
+                    studyId,
+                    series.series_id,
+                    series.files,
+                    (current, total) => {
+                        this.showLoadingState(`Loading DICOM files: ${current}/${total}`);
+                    }
+                );
+
+                if (files.length === 0) {
+                    throw new Error('No DICOM files downloaded. Check Firebase Storage.');
+                }
+
+                if (dicomViewer) {
+                    await dicomViewer.loadImages(files);
+                    console.log(`✓ Loaded ${files.length} images into viewer`);
+                } else {
+                    throw new Error('DICOM viewer not initialized');
+                }
+                return;
+            }
+
             // Check if we have a file list in the series
-            if (series.files && Array.isArray(series.files)) {
+            // New layout: files = {filenames: [...], instance_numbers: [...], slice_locations: [...]}
+            // Legacy layout: files = [{filename, instance_number, slice_location}, ...]
+            const seriesFilenames = this.getSeriesFilenames(series);
+            if (seriesFilenames) {
                 // Use the actual filenames from Firestore
-                const filenames = series.files.map(f => f.filename);
+                const filenames = seriesFilenames;
                 console.log(`Using ${filenames.length} filenames from Firestore metadata`);
                 
                 const files = await storageManager.downloadSeries(
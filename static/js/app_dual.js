@@ -223,11 +223,35 @@ async function loadStudy(study, userProgress) {
 // FILE DOWNLOAD WITH PROGRESS (Using storageManager)
 // =============================================================================
 async function fetchSeriesFiles(studyId, series, seriesType) {
+    // Update progress callback
+    const progressCallback = (current, total) => {
+        const loadingStatus = document.getElementById('loadingStatus');
+        if (loadingStatus) {
+            const seriesName = series.description || seriesType;
+            loadingStatus.textContent = `Downloading ${seriesName}: ${current}/${total}`;
+        }
+    };
+
+    // Packed series: every slice lives in one series.dcm object,
+    // downloaded once and sliced by the recorded byte ranges
+    if (series.files && Array.isArray(series.files.byte_offsets)) {
+        console.log(`Fetching packed ${seriesType} series in one request...`);
+        return await storageManager.downloadPackedSeries(
+            studyId,
+            series.series_id,
+            series.files,
+            progressCallback
+        );
+    }
+
     // Determine filenames based on series data structure
     let filenames = [];
-    
-    if (series.files && Array.isArray(series.files)) {
-        // If series has explicit file list
+
+    if (series.files && Array.isArray(series.files.filenames)) {
+        // New layout: parallel arrays
+        filenames = series.files.filenames;
+    } else if (series.files && Array.isArray(series.files)) {
+        // Legacy layout: array of {filename, ...} objects
         filenames = series.files.map(f => f.filename);
     } else if (series.slice_count) {
         // If series has slice count, generate filenames
@@ -243,15 +267,6 @@ async function fetchSeriesFiles(studyId, series, seriesType) {
 
     console.log(`Fetching ${filenames.length} files for ${seriesType} series...`);
 
-    // Update progress callback
-    const progressCallback = (current, total) => {
-        const loadingStatus = document.getElementById('loadingStatus');
-        if (loadingStatus) {
-            const seriesName = series.description || seriesType;
-            loadingStatus.textContent = `Downloading ${seriesName}: ${current}/${total}`;
-        }
-    };
-
     try {
         // Use storageManager to download files (this should be defined in storage.js)
         const files = await storageManager.downloadSeries(
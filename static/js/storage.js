@@ -44,6 +44,32 @@ class StorageManager {
         }
     }
     
+    // Download a packed series (all slices concatenated into series.dcm)
+    // and slice it back into per-file ArrayBuffers using the byte ranges
+    // recorded in the files metadata
+    async downloadPackedSeries(studyId, seriesId, files, onProgress) {
+        const total = files.filenames.length;
+
+        console.log(`Downloading packed series (${total} slices in one object)...`);
+
+        const packed = await this.downloadDicom(studyId, seriesId, 'series.dcm');
+
+        const result = [];
+        for (let i = 0; i < total; i++) {
+            const start = files.byte_offsets[i];
+            result.push({
+                filename: files.filenames[i],
+                data: packed.slice(start, start + files.byte_lengths[i])
+            });
+
+            if (onProgress) {
+                onProgress(i + 1, total);
+            }
+        }
+
+        return result;
+    }
+
     // Download all DICOMs for a series (with progress callback)
     async downloadSeries(studyId, seriesId, filenames, onProgress) {
         const files = [];
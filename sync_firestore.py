@@ -8,11 +8,25 @@ Sync Firestore metadata with Firebase Storage contents.
 
 import sys
 import json
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from pathlib import Path
 import firebase_admin
 from firebase_admin import credentials, storage, firestore
 import pydicom
 
+# The only DICOM tags we need - lets pydicom skip everything else (sequences included)
+DICOM_TAGS = ['InstanceNumber', 'SliceLocation', 'SeriesDescription']
+
+_DIGITS = re.compile(r'\d+')
+
+def _num_key(filename, _r=_DIGITS):
+    """Sort key: first run of digits in the filename (e.g. '12.dcm' -> 12)."""
+    m = _r.search(filename)
+    return int(m.group(0)) if m else 0
+
 class FirestoreStorageSync:
     def __init__(self, service_account_path, bucket_name):
         """Initialize Firebase connection."""
@@ -34,9 +48,12 @@ class FirestoreStorageSync:
         """Scan Firebase Storage to find all studies and series."""
         print("📂 Scanning Firebase Storage...")
         
-        # Get all blobs in dicoms/ folder
-        blobs = list(self.bucket.list_blobs(prefix='dicoms/'))
-        
+        # Stream blobs page by page, asking the server for names only -
+        # materializing full Blob objects for a large bucket spikes memory
+        blobs = self.bucket.list_blobs(prefix='dicoms/',
+                                       fields='items(name),nextPageToken',
+                                       page_size=1000)
+
         studies = {}
         
         for blob in blobs:
@@ -93,17 +110,27 @@ class FirestoreStorageSync:
             blob_path = f"dicoms/{study_id}/{series_id}/{filename}"
             blob = self.bucket.blob(blob_path)
             
-            # Download to memory
-            dcm_bytes = blob.download_as_bytes()
-            
+            # Ranged GET: the header fits in the first ~16KB, no need to
+            # pull the pixel data over the network just to throw it away
+            dcm_bytes = blob.download_as_bytes(start=0, end=16384)
+
             # Parse DICOM (only header, not pixels)
-            from io import BytesIO
-            dcm = pydicom.dcmread(BytesIO(dcm_bytes), stop_before_pixels=True)
+            dcm = pydicom.dcmread(BytesIO(dcm_bytes), stop_before_pixels=True, force=True,
+                                  specific_tags=DICOM_TAGS)
+
+            # force=True parses a truncated buffer without raising, so a header
+            # that extends past the cut shows up as missing tags rather than an
+            # exception. If the read filled the whole range and a tag we need
+            # is absent, the header was probably cut off - retry with a bigger range.
+            if len(dcm_bytes) > 16384 and any(tag not in dcm for tag in DICOM_TAGS):
+                dcm_bytes = blob.download_as_bytes(start=0, end=65536)
+                dcm = pydicom.dcmread(BytesIO(dcm_bytes), stop_before_pixels=True, force=True,
+                                      specific_tags=DICOM_TAGS)
             
             return {
-                'instance_number': int(dcm.InstanceNumber) if hasattr(dcm, 'InstanceNumber') else 0,
-                'slice_location': float(dcm.SliceLocation) if hasattr(dcm, 'SliceLocation') else 0.0,
-                'series_description': str(dcm.SeriesDescription) if hasattr(dcm, 'SeriesDescription') else ''
+                'instance_number': int(dcm.get('InstanceNumber', 0)),
+                'slice_location': float(dcm.get('SliceLocation', 0.0)),
+                'series_description': str(dcm.get('SeriesDescription', ''))
             }
         except Exception as e:
             print(f"      ⚠️  Could not read metadata from {filename}: {e}")
@@ -113,50 +140,107 @@ class FirestoreStorageSync:
                 'series_description': ''
             }
     
+    async def _gather_metadata(self, study_id, series_id, filenames):
+        """Download metadata for all files concurrently (downloads are I/O-bound)."""
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            return await asyncio.gather(*[
+                loop.run_in_executor(pool, self.download_dicom_metadata, study_id, series_id, filename)
+                for filename in filenames
+            ])
+
     def create_study_metadata(self, study_id, series_dict):
         """Create Firestore metadata from Storage files."""
         print(f"   Creating metadata for study {study_id}...")
         
         series_list = []
-        
+        total_slices = 0
+
         for series_id, filenames in series_dict.items():
             print(f"      Series {series_id}: {len(filenames)} files", end='', flush=True)
             
             # Sort filenames numerically
-            filenames_sorted = sorted(filenames, key=lambda x: int(''.join(filter(str.isdigit, x)) or '0'))
+            filenames_sorted = sorted(filenames, key=_num_key)
             
+            # Download metadata for all files in parallel (each file fetched exactly once)
+            metadata_list = asyncio.run(self._gather_metadata(study_id, series_id, filenames_sorted))
+
             # Get description from first file
-            first_file_metadata = self.download_dicom_metadata(study_id, series_id, filenames_sorted[0])
-            
-            # Create file list
-            file_list = []
-            for filename in filenames_sorted:
-                metadata = self.download_dicom_metadata(study_id, series_id, filename)
-                file_list.append({
-                    'filename': filename,
-                    'instance_number': metadata['instance_number'],
-                    'slice_location': metadata['slice_location']
-                })
-            
+            first_metadata = metadata_list[0]
+
+            # Struct-of-arrays file layout: parallel lists instead of one
+            # dict per slice (smaller documents, fewer allocations)
             series_list.append({
                 'series_id': str(series_id),
-                'description': first_file_metadata['series_description'],
+                'description': first_metadata['series_description'],
                 'slice_count': len(filenames),
-                'files': file_list,
+                'files': {
+                    'filenames': filenames_sorted,
+                    'instance_numbers': [m['instance_number'] for m in metadata_list],
+                    'slice_locations': [m['slice_location'] for m in metadata_list]
+                },
                 'storage_path': f"dicoms/{study_id}/{series_id}/"
             })
-            
+            total_slices += len(filenames)
+
             print(" ✅")
-        
+
         return {
             'study_id': str(study_id),
             'series': series_list,
             'total_series': len(series_list),
-            'total_slices': sum(s['slice_count'] for s in series_list),
+            'total_slices': total_slices,
             'upload_date': firestore.SERVER_TIMESTAMP,
             'status': 'ready'
         }
     
+    @staticmethod
+    def _has_packed_series(series_dict):
+        """True if any Storage series uses the packed single-blob layout."""
+        return any('series.dcm' in files for files in series_dict.values())
+
+    @staticmethod
+    def _packed_matches(series_dict, study_data):
+        """Check a packed study's Firestore document against Storage.
+
+        A packed series stores one series.dcm blob, while its Firestore entry
+        records the original per-slice filenames plus byte ranges, so the
+        plain filename comparison can never match. Instead, require every
+        Storage series to be exactly [series.dcm] and the document to carry a
+        packed entry (byte_offsets present) for the same series ids.
+        """
+        if not all(files == ['series.dcm'] for files in series_dict.values()):
+            return False
+
+        doc_ids = set()
+        for series in study_data.get('series', []):
+            files = series.get('files') or {}
+            if not (isinstance(files, dict) and files.get('byte_offsets')):
+                return False
+            doc_ids.add(str(series.get('series_id')))
+
+        return doc_ids == {str(series_id) for series_id in series_dict}
+
+    @staticmethod
+    def _firestore_filenames(study_data):
+        """Collect all filenames recorded in a Firestore study document."""
+        names = []
+        for series in study_data.get('series', []):
+            files = series.get('files') or {}
+            if isinstance(files, dict):
+                names.extend(files.get('filenames', []))
+            else:
+                # Legacy layout: array of {filename, ...} objects
+                names.extend(f.get('filename', '') for f in files)
+        return names
+
+    def _flush_if_full(self, batch, count):
+        """Commit the batch and start a fresh one before hitting the 500-write limit."""
+        if count >= 499:
+            batch.commit()
+            return self.db.batch(), 0
+        return batch, count
+
     def sync(self, dry_run=True):
         """Sync Firestore with Storage."""
         print("=" * 70)
@@ -217,33 +301,70 @@ class FirestoreStorageSync:
         print("=" * 70)
         print()
         
+        # Queue all writes on a batch - one commit per 499 ops instead of one RPC per study
+        batch = self.db.batch()
+        batch_count = 0
+
         # Delete orphaned studies
         if orphaned_studies:
             print(f"🗑️  Deleting {len(orphaned_studies)} orphaned studies...")
             for study_id in orphaned_studies:
                 doc_id = firestore_studies[study_id]['doc_id']
-                self.db.collection('studies').document(doc_id).delete()
+                batch.delete(self.db.collection('studies').document(doc_id))
+                batch_count += 1
+                batch, batch_count = self._flush_if_full(batch, batch_count)
                 print(f"   ✅ Deleted study {study_id}")
             print()
-        
+
         # Create missing studies
         if missing_studies:
             print(f"➕ Creating {len(missing_studies)} missing studies...")
             for study_id in missing_studies:
+                # Packed byte ranges only exist in the uploader - rebuilding
+                # from Storage headers would write a document describing
+                # series.dcm as a single one-slice file
+                if self._has_packed_series(storage_studies[study_id]):
+                    print(f"   ⚠️  Study {study_id} uses the packed layout - its metadata "
+                          f"can only be rebuilt by upload_dicoms.py, skipping")
+                    continue
                 metadata = self.create_study_metadata(study_id, storage_studies[study_id])
-                self.db.collection('studies').document(str(study_id)).set(metadata)
+                batch.set(self.db.collection('studies').document(str(study_id)), metadata)
+                batch_count += 1
+                batch, batch_count = self._flush_if_full(batch, batch_count)
                 print(f"   ✅ Created study {study_id}")
             print()
-        
+
         # Update existing studies
         if existing_studies:
             print(f"🔄 Updating {len(existing_studies)} existing studies...")
             for study_id in existing_studies:
+                # Skip studies whose file set already matches - no point
+                # re-downloading every header just to write the same document
+                storage_names = sorted(f for files in storage_studies[study_id].values() for f in files)
+                firestore_names = sorted(self._firestore_filenames(firestore_studies[study_id]['data']))
+                if storage_names == firestore_names:
+                    print(f"   ⏭️  Study {study_id} unchanged, skipping")
+                    continue
+                # Never rebuild over a packed study: the byte ranges in its
+                # document cannot be reconstructed from Storage headers here
+                if self._has_packed_series(storage_studies[study_id]):
+                    if self._packed_matches(storage_studies[study_id], firestore_studies[study_id]['data']):
+                        print(f"   ⏭️  Study {study_id} packed and up to date, skipping")
+                    else:
+                        print(f"   ⚠️  Study {study_id} uses the packed layout but its document "
+                              f"doesn't match Storage - re-run upload_dicoms.py for this study")
+                    continue
                 metadata = self.create_study_metadata(study_id, storage_studies[study_id])
-                self.db.collection('studies').document(str(study_id)).set(metadata)
+                batch.set(self.db.collection('studies').document(str(study_id)), metadata)
+                batch_count += 1
+                batch, batch_count = self._flush_if_full(batch, batch_count)
                 print(f"   ✅ Updated study {study_id}")
             print()
-        
+
+        # Commit whatever is left in the final batch
+        if batch_count:
+            batch.commit()
+
         print("=" * 70)
         print("✅ SYNC COMPLETE!")
         print("=" * 70)
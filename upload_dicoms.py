@@ -16,15 +16,60 @@ Features:
 """
 
 import os
+import re
 import sys
 import json
 import time
+import base64
+import multiprocessing
+from io import BytesIO
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import firebase_admin
-from firebase_admin import credentials, storage, firestore
+import requests
+import google_crc32c
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import storage as gcs
+from google.cloud.storage.retry import DEFAULT_RETRY
+from google.oauth2 import service_account
+from firebase_admin import credentials, firestore
 import pydicom
 
+# The only DICOM tags we need - lets pydicom skip everything else (sequences included)
+DICOM_TAGS = ['InstanceNumber', 'SliceLocation', 'SeriesDescription']
+
+_DIGITS = re.compile(r'\d+')
+
+def _num_key(path, _r=_DIGITS):
+    """Sort key: first run of digits in the filename (e.g. '12.dcm' -> 12)."""
+    m = _r.search(path.name)
+    return int(m.group(0)) if m else 0
+
+def _crc32c_b64(data):
+    """crc32c of data, base64-encoded the way GCS reports blob.crc32c."""
+    return base64.b64encode(google_crc32c.value(data).to_bytes(4, 'big')).decode('ascii')
+
+def _parse_dcm_header(dcm_path):
+    """Extract basic metadata from a DICOM file (module-level so it pickles for worker processes)."""
+    try:
+        # defer_size keeps any bulk element (e.g. multi-MB functional group
+        # sequences) as a lazy file-backed reference instead of loading it
+        dcm = pydicom.dcmread(dcm_path, stop_before_pixels=True, defer_size=1024,
+                              specific_tags=DICOM_TAGS)
+        return {
+            'instance_number': int(dcm.get('InstanceNumber', 0)),
+            'slice_location': float(dcm.get('SliceLocation', 0.0)),
+            'series_description': str(dcm.get('SeriesDescription', ''))
+        }
+    except Exception as e:
+        print(f"⚠️  Warning: Could not read DICOM metadata from {dcm_path}: {e}")
+        return {
+            'instance_number': 0,
+            'slice_location': 0.0,
+            'series_description': ''
+        }
+
 class DicomUploader:
     def __init__(self, service_account_path, bucket_name=None):
         """Initialize Firebase connection."""
@@ -36,126 +81,160 @@ class DicomUploader:
             'storageBucket': bucket_name
         })
 
-        self.bucket = storage.bucket()
+        # Dedicated GCS client with a widened connection pool so the upload
+        # threads reuse keep-alive connections instead of re-handshaking TLS
+        gcs_credentials = service_account.Credentials.from_service_account_file(service_account_path)
+        self._gcs_client = gcs.Client(project=gcs_credentials.project_id,
+                                      credentials=gcs_credentials)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32)
+        self._gcs_client._http.mount('https://', adapter)
+
+        self.bucket = self._gcs_client.bucket(bucket_name)
         self.db = firestore.client()
 
+        # Header parsing is CPU-bound; a process pool sidesteps the GIL.
+        # Use spawn, not fork: workers start lazily on first map(), after the
+        # Firestore gRPC channel is live, and forking a process with gRPC
+        # threads/locks is a known source of intermittent hangs.
+        self._parse_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context('spawn'))
+
         print("✅ Firebase initialized successfully")
         print(f"   Storage bucket: {self.bucket.name}")
 
-    def get_dicom_metadata(self, dcm_path):
-        """Extract basic metadata from DICOM file."""
-        try:
-            dcm = pydicom.dcmread(dcm_path, stop_before_pixels=True)
-            return {
-                'instance_number': int(dcm.InstanceNumber) if hasattr(dcm, 'InstanceNumber') else 0,
-                'slice_location': float(dcm.SliceLocation) if hasattr(dcm, 'SliceLocation') else 0.0,
-                'series_description': str(dcm.SeriesDescription) if hasattr(dcm, 'SeriesDescription') else ''
-            }
-        except Exception as e:
-            print(f"⚠️  Warning: Could not read DICOM metadata from {dcm_path}: {e}")
-            return {
-                'instance_number': 0,
-                'slice_location': 0.0,
-                'series_description': ''
-            }
-
-    def upload_dicom_file(self, local_path, storage_path):
-        """Upload single DICOM file to Firebase Storage."""
+    def upload_packed_series(self, buffer, storage_path, existing=None):
+        """Upload a packed series blob to Firebase Storage."""
+        existing_blob = existing.get(storage_path) if existing else None
+
+        # Only skip when the stored blob is byte-identical to what we just
+        # packed. If local slices were added or changed since the last run,
+        # the recorded byte ranges must describe the bytes actually in
+        # Storage, so a stale blob has to be replaced, not skipped.
+        data = buffer.getvalue()
+        if (existing_blob is not None
+                and existing_blob.size == len(data)
+                and existing_blob.crc32c == _crc32c_b64(data)):
+            return False, "Already exists"
+
         blob = self.bucket.blob(storage_path)
 
-        # Check if already exists
-        if blob.exists():
-            return False, "Already exists"
+        # Single-request upload, no resumable session setup
+        blob.chunk_size = None
 
-        # Upload file
-        blob.upload_from_filename(
-            local_path,
-            content_type='application/dicom'
-        )
+        # Create-only (generation 0) for new blobs; when replacing a stale
+        # packed blob, match the generation we just inspected so a concurrent
+        # writer still trips the precondition instead of being clobbered
+        try:
+            buffer.seek(0)
+            blob.upload_from_file(
+                buffer,
+                content_type='application/dicom',
+                if_generation_match=existing_blob.generation if existing_blob else 0,
+                retry=DEFAULT_RETRY
+            )
+        except PreconditionFailed:
+            return False, "Already exists"
 
         return True, "Uploaded"
 
-    def upload_series(self, study_id, series_id, series_dir):
+    def upload_series(self, study_id, series_id, series_dir, existing=None):
         """Upload all DICOM files for a series."""
-        dcm_files = sorted(series_dir.glob('*.dcm'))
+        # scandir avoids glob's fnmatch machinery; sort numerically so the
+        # slice order matches the viewer (1.dcm, 2.dcm, ..., 10.dcm)
+        with os.scandir(series_dir) as it:
+            dcm_files = sorted((Path(e.path) for e in it if e.name.endswith('.dcm')),
+                               key=_num_key)
 
         if not dcm_files:
             return None
 
         print(f"    Series {series_id}: {len(dcm_files)} files", end='', flush=True)
 
-        uploaded_count = 0
-        skipped_count = 0
-        file_list = []
+        # Pack every slice into one blob, recording byte ranges so clients
+        # can fetch the whole series in one GET (or range-read single slices)
+        packed = BytesIO()
+        byte_offsets = []
+        byte_lengths = []
+        for dcm_file in dcm_files:
+            data = dcm_file.read_bytes()
+            byte_offsets.append(packed.tell())
+            byte_lengths.append(len(data))
+            packed.write(data)
 
-        for idx, dcm_file in enumerate(dcm_files, 1):
-            # Storage path: dicoms/study_id/series_id/filename
-            storage_path = f"dicoms/{study_id}/{series_id}/{dcm_file.name}"
+        storage_path = f"dicoms/{study_id}/{series_id}/series.dcm"
+        uploaded, status = self.upload_packed_series(packed, storage_path, existing)
 
-            # Upload file
-            uploaded, status = self.upload_dicom_file(str(dcm_file), storage_path)
+        uploaded_count = len(dcm_files) if uploaded else 0
+        skipped_count = 0 if uploaded else len(dcm_files)
 
-            if uploaded:
-                uploaded_count += 1
-            else:
-                skipped_count += 1
-
-            # Get DICOM metadata
-            metadata = self.get_dicom_metadata(str(dcm_file))
-
-            # Track file info - JUST filename for JavaScript
-            file_list.append({
-                'filename': dcm_file.name,
-                'instance_number': metadata['instance_number'],
-                'slice_location': metadata['slice_location']
-            })
+        # Parse headers across worker processes; results come back in order
+        metadata_list = list(self._parse_pool.map(
+            _parse_dcm_header, [str(p) for p in dcm_files], chunksize=8))
 
-            # Progress indicator
-            if idx % 5 == 0:
-                print('.', end='', flush=True)
+        # Struct-of-arrays file layout: parallel lists instead of one dict
+        # per slice (smaller documents, fewer allocations)
+        filenames = [p.name for p in dcm_files]
+        instance_numbers = [m['instance_number'] for m in metadata_list]
+        slice_locations = [m['slice_location'] for m in metadata_list]
 
-        # Get series description from first DICOM
-        first_dcm_metadata = self.get_dicom_metadata(str(dcm_files[0]))
+        # Series description comes from the first file
+        series_description = metadata_list[0]['series_description']
 
         print(f" ✅ ({uploaded_count} uploaded, {skipped_count} skipped)")
 
         # IMPORTANT: Return series_id as STRING
         return {
             'series_id': str(series_id),  # STRING not integer!
-            'description': first_dcm_metadata['series_description'],
+            'description': series_description,
             'slice_count': len(dcm_files),
-            'files': file_list,  # Array of {filename, instance_number, slice_location}
+            'files': {  # Parallel arrays, index i describes slice i
+                'filenames': filenames,
+                'instance_numbers': instance_numbers,
+                'slice_locations': slice_locations,
+                # Byte ranges of each slice inside the packed series.dcm blob
+                'byte_offsets': byte_offsets,
+                'byte_lengths': byte_lengths
+            },
             'storage_path': f"dicoms/{study_id}/{series_id}/",
             'uploaded_count': uploaded_count,
             'skipped_count': skipped_count
         }
 
-    def upload_study(self, study_dir):
+    def upload_study(self, study_dir, upload_date=None):
         """Upload all series for a study."""
         study_id = study_dir.name  # Keep as string
 
         print(f"\n📁 Study {study_id}")
 
-        # Find all series directories
-        series_dirs = [d for d in study_dir.iterdir() if d.is_dir()]
+        # Find all series directories (DirEntry.is_dir reuses readdir's
+        # d_type, no extra stat per entry)
+        with os.scandir(study_dir) as it:
+            series_dirs = [Path(e.path) for e in it if e.is_dir()]
 
         if not series_dirs:
             print(f"  ⚠️  No series directories found")
             return None
 
+        # One listing per study replaces per-object exists() checks; keep the
+        # Blob objects so upload_packed_series can compare size/crc32c
+        existing = {b.name: b for b in self.bucket.list_blobs(prefix=f"dicoms/{study_id}/")}
+
         series_list = []
         total_uploaded = 0
         total_skipped = 0
+        total_slices = 0
 
         for series_dir in sorted(series_dirs):
             series_id = series_dir.name  # Keep as string
 
-            series_info = self.upload_series(study_id, series_id, series_dir)
+            series_info = self.upload_series(study_id, series_id, series_dir, existing)
 
             if series_info:
                 series_list.append(series_info)
                 total_uploaded += series_info['uploaded_count']
                 total_skipped += series_info['skipped_count']
+                total_slices += series_info['slice_count']
 
         # Create study metadata
         # IMPORTANT: Store study_id as STRING to match JavaScript expectations
@@ -163,8 +242,8 @@ class DicomUploader:
             'study_id': str(study_id),  # STRING not integer
             'series': series_list,
             'total_series': len(series_list),
-            'total_slices': sum(s['slice_count'] for s in series_list),
-            'upload_date': datetime.utcnow().isoformat(),
+            'total_slices': total_slices,
+            'upload_date': upload_date or datetime.utcnow().isoformat(),
             'status': 'ready'
         }
 
@@ -191,7 +270,8 @@ class DicomUploader:
             sys.exit(1)
 
         # Find all study directories
-        study_dirs = [d for d in dicom_root.iterdir() if d.is_dir()]
+        with os.scandir(dicom_root) as it:
+            study_dirs = [Path(e.path) for e in it if e.is_dir()]
 
         if not study_dirs:
             print(f"❌ No study directories found in {dicom_root}")
@@ -213,25 +293,45 @@ class DicomUploader:
         print(f"\n⏰ Started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print("="*70)
 
-        # Upload each study
-        uploaded_studies = []
+        # Upload each study, streaming metadata straight to disk so the
+        # per-file lists never accumulate in memory across studies
+        output_path = 'data/study_metadata.json'
+        os.makedirs('data', exist_ok=True)
+
         failed_studies = []
+        total_studies = 0
+        total_series = 0
+        total_slices = 0
         start_time = time.time()
 
-        for idx, study_dir in enumerate(sorted(study_dirs), 1):
-            print(f"\n[{idx}/{len(study_dirs)}]", end=' ')
+        # One timestamp for the whole run instead of one per study
+        upload_date = datetime.utcnow().isoformat()
 
-            try:
-                study_metadata = self.upload_study(study_dir)
-                if study_metadata:
-                    uploaded_studies.append(study_metadata)
-                else:
+        with open(output_path, 'w') as f:
+            f.write('{"version": "1.0", "generated_at": %s, "studies": [' % json.dumps(upload_date))
+
+            for idx, study_dir in enumerate(sorted(study_dirs), 1):
+                print(f"\n[{idx}/{len(study_dirs)}]", end=' ')
+
+                try:
+                    study_metadata = self.upload_study(study_dir, upload_date)
+                    if study_metadata:
+                        if total_studies:
+                            f.write(', ')
+                        json.dump(study_metadata, f)
+                        total_studies += 1
+                        total_series += study_metadata['total_series']
+                        total_slices += study_metadata['total_slices']
+                    else:
+                        failed_studies.append(study_dir.name)
+                except Exception as e:
+                    print(f"  ❌ Error: {e}")
                     failed_studies.append(study_dir.name)
-            except Exception as e:
-                print(f"  ❌ Error: {e}")
-                failed_studies.append(study_dir.name)
-                import traceback
-                traceback.print_exc()
+                    import traceback
+                    traceback.print_exc()
+
+            f.write('], "total_studies": %d, "total_series": %d, "total_slices": %d}'
+                    % (total_studies, total_series, total_slices))
 
         # Summary
         elapsed_time = time.time() - start_time
@@ -239,33 +339,17 @@ class DicomUploader:
         print("\n" + "="*70)
         print("📊 UPLOAD SUMMARY")
         print("="*70)
-        print(f"✅ Successfully uploaded: {len(uploaded_studies)} studies")
+        print(f"✅ Successfully uploaded: {total_studies} studies")
         print(f"❌ Failed: {len(failed_studies)} studies")
         print(f"⏱️  Total time: {elapsed_time/60:.1f} minutes")
 
         if failed_studies:
             print(f"\n⚠️  Failed studies: {', '.join(failed_studies)}")
 
-        # Save metadata JSON
-        metadata_json = {
-            'version': '1.0',
-            'generated_at': datetime.utcnow().isoformat(),
-            'total_studies': len(uploaded_studies),
-            'total_series': sum(s['total_series'] for s in uploaded_studies),
-            'total_slices': sum(s['total_slices'] for s in uploaded_studies),
-            'studies': uploaded_studies
-        }
-
-        output_path = 'data/study_metadata.json'
-        os.makedirs('data', exist_ok=True)
-
-        with open(output_path, 'w') as f:
-            json.dump(metadata_json, f, indent=2)
-
         print(f"\n💾 Metadata saved to: {output_path}")
-        print(f"   Total studies: {metadata_json['total_studies']}")
-        print(f"   Total series: {metadata_json['total_series']}")
-        print(f"   Total slices: {metadata_json['total_slices']}")
+        print(f"   Total studies: {total_studies}")
+        print(f"   Total series: {total_series}")
+        print(f"   Total slices: {total_slices}")
 
         print("\n✅ Upload complete!")
         
@@ -282,17 +366,24 @@ class DicomUploader:
       "series_id": "2448190387",  // STRING not number!
       "description": "T2",
       "slice_count": 43,
-      "files": [
-        {"filename": "1.dcm", ...},
-        {"filename": "2.dcm", ...},
-        ...
-      ]
+      "files": {
+        "filenames": ["1.dcm", "2.dcm", ...],
+        "instance_numbers": [1, 2, ...],
+        "slice_locations": [-12.5, -8.0, ...],
+        "byte_offsets": [0, 514322, ...],
+        "byte_lengths": [514322, 514318, ...]
+      }
     }
   ]
 }
         """)
 
-        return metadata_json
+        return {
+            'total_studies': total_studies,
+            'total_series': total_series,
+            'total_slices': total_slices,
+            'failed_studies': failed_studies
+        }
 
 def main():
     """Main execution."""
@@ -365,7 +456,7 @@ def main():
 
     # Upload studies
     max_studies = 3 if trial_mode else None
-    metadata = uploader.upload_studies(dicom_directory, trial_mode, max_studies)
+    uploader.upload_studies(dicom_directory, trial_mode, max_studies)
 
     print("\n🎉 All done!")
     print("\n" + "="*70)